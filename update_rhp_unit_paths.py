@@ -3,111 +3,266 @@
 
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
-from pathlib import Path
 import logging
 
 # Configuration
 # 
 rpyxPathToProcessList = [ "../../Systems/CVI3/CVI3.rpyx" ]
 
+# number of threads reading the rpyx files concurrently
+maxReadWorkers = 16
+
+
+# regex matching the rpyx links in the file contents, compiled once for all files
+# the class avoids backtracking to the end of the file on every '>' found, and keeps a
+# match from swallowing surrounding markup : a link token is a file path, never '<' or '>',
+# and never spans several lines (free text in a rpyx may contain lone '>' characters)
+# the pattern is bytes : files are read in binary mode, no decode/encode of the whole contents
+_LINK_RE = re.compile( rb">([^<>\r\n]*)_rpy<" )
+
+# per-folder cache of the file names, filled with one scandir instead of one stat per rpyx
+_DIR_CACHE : dict[ str, set[ str ] ] = dict()
+
+# interning of the link tokens : the same rpyx is referenced from many files, so the
+# bytes tokens and link strings extracted from each file collapse to a single copy
+_TOKEN_INTERN : dict = dict()
+
+# cache of os.path.relpath results, keyed on (target, parent folder) : files of a same
+# folder referencing the same rpyx all share one computation
+_RELPATH_CACHE : 'dict[tuple[str, str], str]' = dict()
+
+# posix_fadvise only exists on Linux ; on other platforms the prefetch is simply skipped
+_HAS_FADVISE = hasattr( os, 'posix_fadvise' )
+
+log = logging.getLogger( __name__ )
+
+# per-link tracing and per-file debug logs, off by default : a release run on a big
+# project pays no LogRecord allocation, set RPYX_TRACE=1 to get them back
+_TRACE = bool( os.environ.get( 'RPYX_TRACE' ) )
+
 
 
 class RhpRpyx:
     """represents a Rhp project files"""
 
-    def __init__( self, path : str ):
-
-        self.absPath : str = os.path.abspath( path )
-        self.exists : bool = os.path.exists( self.absPath )
+    # no per-instance __dict__ : thousands of RhpRpyx are built on a big project
+    __slots__ = ( 'absPath', 'absPathKey', '_absParentDir', 'exists',
+                  'fileContent', '_linkMatches', 'linksDico', 'replacementsDico' )
+
+    def __init__( self, path : str, resolvedPath : bool = False ):
+
+        # abspath queries the cwd : skip it when the caller already resolved the path
+        self.absPath : str = path if resolvedPath else os.path.abspath( path )
+        # lowercase bytes key computed once, instead of one .lower() per index lookup ;
+        # hashing bytes skips the unicode kind dispatch, and fsencode is a no-op on Linux
+        # interned : the key is compared on every index lookup, identity short-circuits equality
+        absPathKey = os.fsencode( self.absPath.lower() )
+        self.absPathKey : bytes = _TOKEN_INTERN.setdefault( absPathKey, absPathKey )
+        # cached once : relative links of this rpyx are all resolved against its parent folder
+        self._absParentDir, baseName = os.path.split( self.absPath )
+        self.exists : bool = baseName in self.listDirCached( self._absParentDir )
+        self.fileContent = None
+        # (start, end, token) of every link matched in the file, kept for the replacement splice
+        self._linkMatches : 'list[tuple[int, int, bytes]]' = list()
         self.linksDico : dict[ str, RhpRpyx ] = dict()
-        self.replacementsDico : dict[ str, str ] = dict()
+        self.replacementsDico : dict[ bytes, bytes ] = dict()
+
+
+    @staticmethod
+    def listDirCached( dirPath : str ) -> 'set[str]':
+        """liste le dossier une seule fois : un readdir remplace un stat par fichier du dossier"""
+
+        dirContent = _DIR_CACHE.get( dirPath )
+
+        if None == dirContent:
+            try:
+                dirContent = { dirEntry.name for dirEntry in os.scandir( dirPath ) }
+            except OSError:
+                dirContent = set()
+            _DIR_CACHE[ dirPath ] = dirContent
+
+        return dirContent
 
 
     def trace(self):
 
         # recherche des réf de rpyx au dico
-        logging.info( "Links of " + self.absPath)
+        log.info( "Links of %s", self.absPath )
 
         for link, rpyx in self.linksDico.items():
-            
+
             # is there a replacement for this link
-            replacedStr = self.rpyxToMatch( link )
-            newStr = self.replacementsDico.get( replacedStr )
+            newStr = self.replacementsDico.get( self.rpyxToToken( link ).encode() )
 
-            logging.log( 
-                ( logging.WARNING if not rpyx.exists else logging.INFO if newStr is not None else logging.DEBUG ),
-                "    " + replacedStr + 
-                ( " folder exists" if rpyx.exists else " does not exists" ) +
-                ( " => " + newStr if newStr != None else "" ) )
+            level = ( logging.WARNING if not rpyx.exists else logging.INFO if newStr is not None else logging.DEBUG )
 
+            # no message built at all when the level is filtered out
+            if not log.isEnabledFor( level ):
+                continue
 
-    def getLinkedRpyx( self ) -> 'dict[str, RhpRpyx]':
-        """   read the file to get all links toward other rhpRpyx
-        """
+            log.log( level,
+                "    %s%s%s",
+                self.rpyxToMatch( link ),
+                ( " folder exists" if rpyx.exists else " does not exists" ),
+                ( " => " + newStr.decode() if newStr != None else "" ) )
+
+
+    def readFileContent( self ):
+        """lit le fichier en mémoire ; sans état partagé, appelable depuis le pool de threads de lecture"""
 
         try:
-            with open( self.absPath, 'r' ) as openRpyx:
+            with open( self.absPath, 'rb' ) as openRpyx:
                 self.fileContent = openRpyx.read()
 
         except IOError as ioex:
             logging.error("Error reading file %s : %s", self.absPath, ioex)
             raise ioex
 
-        # recherche des réf de rpyx
-        matchs = re.findall( ">.*_rpy<", self.fileContent ) 
 
-        # transform links to point to the rpyx file
-        rhpLinksStr = ( self.matchToRpyx( match ) for match in matchs )
-        
-        # build the dictionary of the linked Rpyx
+    def getLinkedRpyx( self, index : 'RhpIndex' ) -> 'dict[str, RhpRpyx]':
+        """   read the file to get all links toward other rhpRpyx
+        """
+
+        if None == self.fileContent:
+            self.readFileContent()
+
+        # recherche des réf de rpyx ; les positions des liens sont gardées
+        # pour que doReplacements réécrive le fichier sans le rescanner
+        self._linkMatches = list()
+
+        for match in _LINK_RE.finditer( self.fileContent ):
+            token = match.group(1)
+            token = _TOKEN_INTERN.setdefault( token, token )
+            self._linkMatches.append( ( match.start(), match.end(), token ) )
+
+        # build the dictionary of the linked Rpyx, in one specialised loop :
+        # no method dispatch per link, only the short link tokens are decoded,
+        # and the indexed RhpRpyx is reused when the link is already known
         # absolute path of the parent Rpyx is used in case a relative path is used for the linked Rpyx
-        rhpRpyxFiles =  { rhpLink :  RhpRpyx( rhpLink ) if os.path.isabs( rhpLink ) 
-                else RhpRpyx( self.joinRelativePath( rhpLink ) )
-            for rhpLink 
-            in rhpLinksStr }
+        rhpRpyxFiles : dict[ str, RhpRpyx ] = dict()
+        hasAbsoluteLink = False
+
+        for matchStart, matchEnd, token in self._linkMatches:
+
+            rhpLink = token.decode() + ".rpyx"
+            rhpLink = _TOKEN_INTERN.setdefault( rhpLink, rhpLink )
+
+            if os.path.isabs( rhpLink ):
+                absLink = os.path.normpath( rhpLink )
+                hasAbsoluteLink = True
+            else:
+                absLink = os.path.normpath( os.path.join( self._absParentDir, rhpLink ) )
+
+            # the folder cache answers the existence without a stat : links on a missing
+            # file all share the placeholder instead of allocating and indexing a RhpRpyx
+            linkDir, linkBaseName = os.path.split( absLink )
+
+            if linkBaseName in self.listDirCached( linkDir ):
+                rhpRpyxFiles[ rhpLink ] = ( index.getIndexedRhpyx( os.fsencode( absLink.lower() ) )
+                    or RhpRpyx( absLink, resolvedPath = True ) )
+            else:
+                rhpRpyxFiles[ rhpLink ] = _missingRpyx
+
+        # sans lien absolu il n'y aura aucun remplacement : inutile de garder le contenu
+        # du fichier en mémoire jusqu'à la phase d'écriture
+        if not hasAbsoluteLink:
+            self.fileContent = None
+            self._linkMatches = list()
 
         return rhpRpyxFiles
-        
-        
-    def joinRelativePath( self, relativePath : str) -> str:
-        """retourne le chemin absolu d'un lien sur un Rpyx à partir du chemin absolu de ce rpyx"""
-        return os.path.normpath( os.path.join( Path( self.absPath ).absolute(), relativePath ) )
 
-    def matchToRpyx( self, match : str ) -> str:
-        return ( match.lstrip('>').rstrip('<').replace("_rpy", "", 1) + ".rpyx" )
+
+    def relativeToParentDir( self, rhpLink : str ) -> str:
+        """chemin relatif au dossier parent de ce rpyx ; simple slice quand le lien est directement sous ce dossier"""
+
+        parentPrefix = self._absParentDir + os.sep
+
+        if rhpLink.startswith( parentPrefix ):
+            return rhpLink[ len( parentPrefix ) : ]
+
+        cacheKey = ( rhpLink, self._absParentDir )
+        relLink = _RELPATH_CACHE.get( cacheKey )
+
+        if None == relLink:
+            relLink = os.path.relpath( rhpLink, self._absParentDir )
+            _RELPATH_CACHE[ cacheKey ] = relLink
+
+        return relLink
 
     def rpyxToMatch( self, rpyx : str ) -> str:
-        return ( '>' + rpyx.replace(".rpyx", "", 1) + "_rpy<" )
+        return ( '>' + self.rpyxToToken( rpyx ) + "_rpy<" )
+
+    def rpyxToToken( self, rpyx : str ) -> str:
+        return rpyx.replace(".rpyx", "", 1)
 
     def linkRpyx( self, inFilePath : str, newRpyx : 'RhpRpyx' ):
         self.linksDico[ inFilePath ] = newRpyx     
 
     def prepareReplacements( self ):
+        # keyed on the inner link token as bytes, so doReplacements can look up the capture of _LINK_RE directly
         self.replacementsDico = {
-            self.rpyxToMatch( rhpLink ) : self.rpyxToMatch( os.path.relpath( rhpLink, Path( self.absPath ).absolute() ) )
+            self.rpyxToToken( rhpLink ).encode() : self.rpyxToMatch( self.relativeToParentDir( rhpLink ) ).encode()
             for rhpLink in self.linksDico.keys() if os.path.isabs( rhpLink )
         }
 
     def doReplacements( self ):
         """writes replacements from self.replacementsDico into the rpyx file"""
 
-        newContent : str = self.fileContent
+        # single linear splice : the link positions are already known from getLinkedRpyx,
+        # no second scan of the file is needed
+        # the unchanged spans are memoryviews on the contents, so the only copy of the
+        # file data is the final join
+        contentView = memoryview( self.fileContent )
+        parts = list()
+        previousEnd = 0
+
+        for matchStart, matchEnd, token in self._linkMatches:
+
+            newStr = self.replacementsDico.get( token )
+
+            if newStr != None:
+                parts.append( contentView[ previousEnd : matchStart ] )
+                parts.append( newStr )
+                previousEnd = matchEnd
 
-        for oldStr, newStr in self.replacementsDico.items():
-            newContent = newContent.replace( oldStr, newStr )
+        parts.append( contentView[ previousEnd : ] )
 
+        newContent : bytes = b"".join( parts )
+
+        # single write on a raw fd : no TextIOWrapper, no codec, no buffered flush sequence
+        # O_BINARY keeps Windows from translating line endings, it is 0 elsewhere
         try:
-            with open( self.absPath, 'w' ) as openRpyx:
-                openRpyx.write( newContent )
+            writeFd = os.open( self.absPath,
+                os.O_WRONLY | os.O_TRUNC | os.O_CREAT | getattr( os, 'O_BINARY', 0 ), 0o644 )
+            try:
+                os.write( writeFd, newContent )
+            finally:
+                os.close( writeFd )
 
         except IOError as ioex:
             logging.error("Error writing file %s : %s", self.absPath, ioex)
             raise ioex
 
+        # the contents is the largest allocation of the instance, release it once written
+        self.fileContent = None
+        self._linkMatches = list()
+
+
+# shared placeholder for every link whose target file does not exist : .exists is False
+# and its dicos stay empty, so one instance can stand in for all the broken links
+_missingRpyx = RhpRpyx( "__missing__.rpyx" )
+# forced : the contract of the placeholder is .exists == False unconditionally, even if
+# a file named __missing__.rpyx happens to sit in the working directory
+_missingRpyx.exists = False
+
 
 class ReplacementStrategy:
     """Stratégie abstraite de remplacement des liens"""
+
+    __slots__ = ()
+
     def prepareAndCountReplacements( self, rhpRpyx : RhpRpyx ):
         pass
 
@@ -118,6 +273,8 @@ class ReplacementStrategy:
 class RelativePathReplacementStrategy( ReplacementStrategy ):
     """Stratégie de remplacement des liens, passage en chemin relatif"""
 
+    __slots__ = ( 'linkCount', 'replacementCount', 'fileUpdatedCount', 'updatedFileCount', 'maxFileToUpdate' )
+
     def __init__(self, maxFileToUpdate : int) -> None:
         super().__init__()
         self.linkCount : int = 0
@@ -141,18 +298,21 @@ class RelativePathReplacementStrategy( ReplacementStrategy ):
         """Effectue les remplacements dans le rpyx physique"""
 
         if not rhpRpyx.exists:
-            logging.debug( f"Ignoring file {rhpRpyx.absPath}, as it does not exist" )
+            if _TRACE:
+                logging.debug( "Ignoring file %s, as it does not exist", rhpRpyx.absPath )
             return
 
         replacementCount = len( rhpRpyx.replacementsDico )
         if replacementCount == 0:
-            logging.debug( f"Skipping file {rhpRpyx.absPath}, as there is no replacement to do" )
+            if _TRACE:
+                logging.debug( "Skipping file %s, as there is no replacement to do", rhpRpyx.absPath )
             return
 
         if ( self.updatedFileCount < self.maxFileToUpdate ):
             rhpRpyx.doReplacements()
 
-        logging.debug( f"{replacementCount} replacements written in file {rhpRpyx.absPath}" )
+        if _TRACE:
+            logging.debug( "%s replacements written in file %s", replacementCount, rhpRpyx.absPath )
 
         self.updatedFileCount += 1
 
@@ -163,25 +323,25 @@ class RelativePathReplacementStrategy( ReplacementStrategy ):
 #
 class RhpIndex:
 
+    __slots__ = ( 'indexByAbsPath', )
+
     def __init__( self ):
-        self.indexByAbsPath : dict[ str, RhpRpyx ] = dict()
+        self.indexByAbsPath : dict[ bytes, RhpRpyx ] = dict()
 
-    # get an indexed RhpRpyx
-    def getIndexedRhpyx( self, absolutePath : str ) -> Union[RhpRpyx, None]:
-        lowerAbsPath = absolutePath.lower()
-        return self.indexByAbsPath.get( lowerAbsPath )
+    # get an indexed RhpRpyx, from a key already lowercased by the caller
+    def getIndexedRhpyx( self, absPathKey : bytes ) -> Union[RhpRpyx, None]:
+        return self.indexByAbsPath.get( absPathKey )
 
 
     # add an indexed RhpRpyx, and get it
     def addIndexedRhpyx( self, rpyx : RhpRpyx ):
 
-        lowerAbsPath = rpyx.absPath.lower()
-
-        indexedRpyx = self.indexByAbsPath.get( lowerAbsPath )
+        indexedRpyx = self.indexByAbsPath.get( rpyx.absPathKey )
 
         if None == indexedRpyx:
-            logging.debug( "Adding " + lowerAbsPath + " to index" )
-            self.indexByAbsPath[ lowerAbsPath ] = rpyx
+            if _TRACE:
+                logging.debug( "Adding %s to index", rpyx.absPath )
+            self.indexByAbsPath[ rpyx.absPathKey ] = rpyx
             
 
 class RhpLinksUpdater():
@@ -200,7 +360,7 @@ class RhpLinksUpdater():
             
             logging.info( "Apply '%s' to file %s", type(replaceStrategy).__name__, rpyxPathToProcess )
             rhpRpyx = RhpRpyx( rpyxPathToProcess )
-            self.rhpIndex.getIndexedRhpyx( rhpRpyx.absPath )
+            self.rhpIndex.addIndexedRhpyx( rhpRpyx )
 
             if not rhpRpyx.exists:
                 #  logging.warning("\033[33m"+ rhpRpyx.absPath+ " does not exist\033[39m")
@@ -213,47 +373,86 @@ class RhpLinksUpdater():
             self.replacementStrategy.doReplacements( indexedRpyx )
 
 
+    @staticmethod
+    def prefetchFrontier( rpyxFrontier : 'list[tuple[RhpRpyx, int]]' ):
+        """
+        Demande au noyau le readahead de tous les fichiers d'un front (Linux uniquement) :
+        les lectures du pool de threads trouvent alors les pages déjà en cache
+        """
+
+        if not _HAS_FADVISE:
+            return
+
+        for rpyx, depth in rpyxFrontier:
+            if rpyx.exists:
+                try:
+                    readFd = os.open( rpyx.absPath, os.O_RDONLY )
+                    try:
+                        os.posix_fadvise( readFd, 0, 0, os.POSIX_FADV_WILLNEED )
+                    finally:
+                        os.close( readFd )
+                except OSError:
+                    # le prefetch n'est qu'une optimisation, la lecture signalera la vraie erreur
+                    pass
+
+
     def searchLinks( self, existingRhpRpyx : RhpRpyx, maxDepth : int = -1  ):
         """
-        Recherche des liens d'un RhpRpyx vers d'autres RhpRpyx 
+        Recherche des liens d'un RhpRpyx vers d'autres RhpRpyx
         """
 
-        # get RhpxLinks as they are written in the file rhpRpyx
-        linkedRpyxDico = existingRhpRpyx.getLinkedRpyx()
+        # parcours en largeur front par front : pas de limite de récursion,
+        # et tous les fichiers d'un front sont lus en parallèle par le pool de threads
+        rpyxToSearchFrontier : 'list[tuple[RhpRpyx, int]]' = [ ( existingRhpRpyx, maxDepth ) ]
 
         alreadyIndexedRpyx : Union[RhpRpyx, None] = None
 
-        listNewRpyxToSearchLinks : list[RhpRpyx] = list()
+        with ThreadPoolExecutor( max_workers = maxReadWorkers ) as readExecutor:
 
-        # index all rhpRpyx links if they are note already indexed
-        for inFileRhpxLink, linkedRpyx in linkedRpyxDico.items():
-            
-            # build absolute path from
-            alreadyIndexedRpyx = self.rhpIndex.getIndexedRhpyx( linkedRpyx.absPath )
+            while rpyxToSearchFrontier:
+
+                # annonce au noyau toutes les lectures du front d'un coup :
+                # le readahead des fichiers démarre avant que le pool ne les lise
+                self.prefetchFrontier( rpyxToSearchFrontier )
+
+                # lecture concurrente : seule l'I/O est faite dans les threads,
+                # l'index et les dicos sont modifiés uniquement dans le thread principal
+                for _ in readExecutor.map( RhpRpyx.readFileContent, [ rpyx for rpyx, depth in rpyxToSearchFrontier ] ):
+                    pass
+
+                nextFrontier : 'list[tuple[RhpRpyx, int]]' = list()
+
+                for searchedRpyx, depth in rpyxToSearchFrontier:
+
+                    # get RhpxLinks as they are written in the file rhpRpyx
+                    linkedRpyxDico = searchedRpyx.getLinkedRpyx( self.rhpIndex )
+
+                    # index all rhpRpyx links if they are note already indexed
+                    for inFileRhpxLink, linkedRpyx in linkedRpyxDico.items():
+
+                        # build absolute path from
+                        alreadyIndexedRpyx = self.rhpIndex.getIndexedRhpyx( linkedRpyx.absPathKey )
+
+                        # add the Rpyx
+                        searchedRpyx.linkRpyx( inFileRhpxLink, alreadyIndexedRpyx or linkedRpyx )
+
+                        # add to index, and queue the new rpyx to search its links
+                        if None == alreadyIndexedRpyx:
 
-            # add the Rpyx
-            existingRhpRpyx.linkRpyx( inFileRhpxLink, alreadyIndexedRpyx or linkedRpyx )
+                            self.rhpIndex.addIndexedRhpyx( linkedRpyx )
 
-            # add to index 
-            if None == alreadyIndexedRpyx:
+                            if linkedRpyx.exists and depth != 0:
+                                nextFrontier.append( ( linkedRpyx, depth - 1 ) )
 
-                self.rhpIndex.addIndexedRhpyx( linkedRpyx ) 
+                    # prepare les remplacements
+                    self.replacementStrategy.prepareAndCountReplacements( searchedRpyx )
 
-                # add this rpyx to the list to search link
-                if linkedRpyx.exists:
-                    listNewRpyxToSearchLinks.append( linkedRpyx )
+                    # for rhpLink in searchedRpyx.linksDico.values():
+                    if _TRACE:
+                        searchedRpyx.trace()
 
-        # prepare les remplacements 
-        self.replacementStrategy.prepareAndCountReplacements( existingRhpRpyx )
-                    
-        # for rhpLink in existingRhpRpyx.linksDico.values():
-        existingRhpRpyx.trace()
+                rpyxToSearchFrontier = nextFrontier
 
-        # read recursively linked rpyxfiles
-        if maxDepth != 0:
-            for notSearchedRpyx in listNewRpyxToSearchLinks:
-                self.searchLinks( notSearchedRpyx, maxDepth -1 )
-        
 
 
 